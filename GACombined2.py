@@ -1,25 +1,34 @@
 import argparse
 import datetime
-import win_unicode_console
-from apiclient.discovery import build
-import httplib2
-from oauth2client import client
-from oauth2client import file
-from oauth2client import tools
-import argparse
-import pandas as pd
-from pandas import ExcelWriter
-import openpyxl
-from googleAPIget_service import get_service
-from progress.bar import IncrementalBar
-from googleapiclient.errors import HttpError
-import json
-from urllib.parse import urlparse
+import os
+import re
+import googleAPIcache
+from googleAPIdomains import root_domain
+from concurrent.futures import ThreadPoolExecutor
+import threading
 #import sys
 
-win_unicode_console.enable()
-
-debugvar = False
+# only the Windows console needs fixing up for unicode output
+if os.name == 'nt':
+    import win_unicode_console
+    win_unicode_console.enable()
+
+# the date formats the Core Reporting API accepts
+gaRelativeDatePattern = re.compile(r'^(today|yesterday|[0-9]+daysAgo)$')
+gaFixedDatePattern = re.compile(r'^[0-9]{4}-[0-9]{2}-[0-9]{2}$')
+
+def gaDate(value):
+    # checked once here so a typo fails straight away instead of on every view
+    if gaRelativeDatePattern.match(value):
+        return value
+    try:
+        # the pattern insists on the zero padding GA needs, strptime on a real date
+        if not gaFixedDatePattern.match(value):
+            raise ValueError(value)
+        datetime.datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid date '" + value + "', use yyyy-mm-dd, 'today', 'yesterday' or 'NdaysAgo'")
+    return value
 
 parser = argparse.ArgumentParser()
 
@@ -28,56 +37,182 @@ results = {}
 
 
 #parser.add_argument("viewProfileID",type=int, help="GA View (profile) ID as a number") !!!already got this from loop!!!
-parser.add_argument("start_date", help="start date in format yyyy-mm-dd or 'yesterday' '7DaysAgo'")
-parser.add_argument("end_date", help="start date in format yyyy-mm-dd or 'today'")
+parser.add_argument("start_date", type=gaDate, help="start date in format yyyy-mm-dd or 'yesterday' '7daysAgo'")
+parser.add_argument("end_date", type=gaDate, help="start date in format yyyy-mm-dd or 'today'")
 parser.add_argument("-f","--filters",default='ga:pageviews>2', help="Filter, default is 'ga:pageviews>2'")
 parser.add_argument("-d","--dimensions",default="ga:pagePath", help="The dimensions are the left hand side of the table, default is pagePath. YOU HAVE TO ADD 'ga:' before your dimension")
 parser.add_argument("-m","--metrics",default="ga:pageviews", help="The metrics are the things on the left, default is pageviews. YOU HAVE TO ADD 'ga:' before your metric")
 parser.add_argument("-n","--name",default='analytics-' + datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S"),type=str, help="File name for final output, default is analytics- + the current date. You do NOT need to add file extension.")
+parser.add_argument("-o","--output",default="auto",choices=("auto","xlsx","csv"), help="Output file type, default is auto which writes xlsx unless there are more than 100000 rows, then csv. csv writes each account's rows out as soon as it is done instead of keeping everything in memory, use it for big downloads.")
 parser.add_argument("-t","--test",nargs='?',const=3,type=int,help="Test option which makes the script output only n results, default is 3.")
+parser.add_argument("--refresh",action="store_true", help="Ignore cached data and fetch it again: the list of views (kept for a day, refresh after starring a new view) and results of queries for fixed dates more than two days ago.")
+parser.add_argument("--retries",default=5,type=int, help="How many times a request is retried, with an increasing random wait, when GA reports a rate limit or server error. Default is 5.")
+parser.add_argument("-w","--workers",default=4,type=int, help="Number of views queried in parallel, default is 4. Keep this low, GA limits concurrent requests per view and queries per second.")
+parser.add_argument("--debug",action="store_true", help="Print what the script is doing, including every view's rows. Slow for big downloads.")
 #parser.add_argument("-c", "--clean", action="count", default=0, help="clean output skips header and count and just sends csv rows")
 
 parser.add_argument("-g","--googleaccount",type=str, default="", help="Name of a google account; does not have to literally be the account name but becomes a token to access that particular set of secrets. Client secrets will have to be in this a file that is this string concatenated with client_secret.json.  OR if this is the name of a text file then every line in the text file is processed as one user and all results appended together into a file file")
 
 args = parser.parse_args()
 
+# pandas and the Google client libraries take a while to load, so they are only
+# imported once the arguments are known to be good (--help stays instant)
+import httplib2
+import pandas as pd
+from googleAPIoutput import append_csv, empty_csv, write_results
+from googleAPIget_service import get_service, get_credentials, get_accounts
+from progress.bar import IncrementalBar
+from googleapiclient.errors import HttpError
+
 start_date = args.start_date
 end_date = args.end_date
 filters = args.filters
 dimensions = args.dimensions
 metrics = args.metrics
 name = args.name
+output = args.output
 test = args.test
+# ThreadPoolExecutor needs at least one worker
+workers = max(1, args.workers)
+retries = args.retries
+refresh = args.refresh
+debugvar = args.debug
 googleaccountstring = args.googleaccount
 
-options = [[start_date,end_date,filters,dimensions,metrics,name,googleaccountstring]]
-optionsdf = pd.DataFrame(options, columns=["start_date","end_date","filters","dimensions","metrics","name","Google Account"])
-if debugvar: print(optionsdf)
+optionsColumns = ["start_date","end_date","filters","dimensions","metrics","name","Google Account"]
+options = [start_date,end_date,filters,dimensions,metrics,name,googleaccountstring]
+if debugvar: print(dict(zip(optionsColumns, options)))
 
 splitMetrics = metrics.split(',')
+splitDimensions = dimensions.split(',')
+# the columns of a view's rows, in the order the API returns them
+resultColumns = splitDimensions + splitMetrics
+# page path reports also get a full Url column
+pagePathReport = dimensions == "ga:pagePath"
+
+# the most rows the Core Reporting API returns for one query, bigger results come in pages
+maxResultsPerPage = 10000
+
+# the query is the same for every view apart from the view id
+queryParameters = dict(
+    start_date=start_date,
+    end_date=end_date,
+    filters=filters,
+    #sort='-ga:pageviews', 
+    max_results=maxResultsPerPage,
+    dimensions= dimensions,
+    metrics= metrics)
 
 scope = ['https://www.googleapis.com/auth/analytics.readonly']
 
-try:
-    googleaccountslist = open(googleaccountstring).read().splitlines()
-    # remove empty lines
-    googleaccountslist = [x.strip() for x in googleaccountslist if x.strip()]
-except:
-    googleaccountslist = [googleaccountstring]
+profilesCacheSeconds = 24 * 60 * 60
+
+# Query results are only cached when they can't change anymore: both dates are fixed
+# and the range ended before GA's processing delay (up to two days)
+lastFinalDate = (datetime.date.today() - datetime.timedelta(days=2)).isoformat()
+cacheResults = (gaFixedDatePattern.match(start_date) is not None
+                and gaFixedDatePattern.match(end_date) is not None
+                and end_date < lastFinalDate)
+
+googleaccountslist = get_accounts(googleaccountstring)
 
 if debugvar: print(googleaccountslist)
 
-if ',' in metrics:
-    splitMetrics = metrics.split(',')
-    if dimensions == "ga:pagePath":
-        combinedDF = pd.DataFrame(columns=['viewid','Url',dimensions])
-    else:
-        combinedDF = pd.DataFrame(columns=['viewid',dimensions])
-else:
-    if dimensions == "ga:pagePath":
-        combinedDF = pd.DataFrame(columns=['viewid','Url',dimensions,metrics])
-    else:
-        combinedDF = pd.DataFrame(columns=['viewid',dimensions,metrics])
+# empty frame with the output columns, so they are there even if no view returns data
+templateColumns = ['rootDomain', 'viewid', 'websiteUrl'] + resultColumns
+if pagePathReport:
+    templateColumns.insert(3,'Url')
+combinedDF = pd.DataFrame(columns=templateColumns)
+
+threadLocal = threading.local()
+
+def threadHttp(credentials):
+    # httplib2.Http is not thread safe, so each worker thread gets its own authorized one.
+    # Pool threads can outlive an account, so a new account's credentials need a new Http
+    if getattr(threadLocal, 'credentials', None) is not credentials:
+        threadLocal.http = credentials.authorize(httplib2.Http())
+        threadLocal.credentials = credentials
+    return threadLocal.http
+
+def queryView(service, credentials, viewId):
+    # Run the query for one view, following the pages until every row is in
+    http = threadHttp(credentials)
+    results = service.data().ga().get(
+    ids='ga:' + viewId,
+    **queryParameters).execute(http=http, num_retries=retries)
+    startIndex = 1
+    while 'nextLink' in results:
+        startIndex += maxResultsPerPage
+        page = service.data().ga().get(
+        ids='ga:' + viewId,
+        start_index=startIndex,
+        **queryParameters).execute(http=http, num_retries=retries)
+        results['rows'].extend(page.get('rows', []))
+        if 'nextLink' in page:
+            results['nextLink'] = page['nextLink']
+        else:
+            del results['nextLink']
+    return results
+
+def fetchView(service, credentials, item):
+    # Query one view, returns a DataFrame of its rows or None if there was no data
+    results = {}
+    dataPresent = False
+    if debugvar: print(item['id'] + ',' + start_date + ',' + end_date)
+
+    if debugvar: print("Try querying: "+ str(item['id'])+":"+  item['websiteUrl'])
+    try:
+        resultsCacheKey = ('analytics-data', item['id'], queryParameters)
+        results = None
+        if cacheResults and not refresh:
+            results = googleAPIcache.load(resultsCacheKey)
+        if results is None:
+            results = queryView(service, credentials, str(item['id']))
+            if cacheResults:
+                googleAPIcache.save(resultsCacheKey, results)
+        if results['totalResults'] > 0:
+            dataPresent = True
+    except HttpError as err:
+        # if err.resp.get('content-type', '').startswith('application/json'):
+        #     reason = json.loads(err.content).get('error').get('errors')[0].get('reason')
+        #     raise HttpError("HTTP data was invalid or unexpected /n Reason is:",)
+        #     print(reason)
+        # else:
+        #     raise HttpError("HTTP data was invalid or unexpected")
+        print(err.resp.status, err._get_reason())
+    except:
+        if debugvar: print("GA call failed for " + item['websiteUrl'])
+        dataPresent = False
+
+    if not dataPresent:
+        return None
+
+    if debugvar: print("returned rows: " + str(results['rows']))
+    # rows come back as lists of values, transpose them and hand pandas whole columns
+    columns = dict(zip(resultColumns, zip(*results['rows'])))
+    # metric values are strings in the response, type them while building the frame
+    for metric in splitMetrics:
+        columns[metric] = pd.to_numeric(columns[metric])
+    smalldf = pd.DataFrame(columns)
+    if debugvar: print(smalldf)
+
+    smalldf.insert(0,'viewid',item['id'])
+    if debugvar: print(smalldf)
+
+    smalldf.insert(1,'websiteUrl',item['websiteUrl'])
+    if pagePathReport:
+        smalldf['Url'] = smalldf['websiteUrl'] + smalldf[dimensions]
+
+    smalldf.insert(0,'rootDomain',root_domain(item['websiteUrl']))
+    return smalldf
+
+if googleaccountstring > "" :
+    name = googleaccountstring + "-" + name 
+
+# Every view's DataFrame is collected here and concatenated once at the end,
+# concatenating inside the loop copies everything collected so far each time
+frames = []
+csvStarted = False
 
 numberOfAccountsDone = 0
 for thisgoogleaccount in googleaccountslist:
@@ -85,111 +220,70 @@ for thisgoogleaccount in googleaccountslist:
         break
     numberOfAccountsDone += 1
     if debugvar: print(thisgoogleaccount)
-    if ',' in metrics:
-        if dimensions == "ga:pagePath":
-            bigdf = pd.DataFrame(columns=['viewid','Url',dimensions])
-        else:
-            bigdf = pd.DataFrame(columns=['viewid',dimensions])
-    else:
-        if dimensions == "ga:pagePath":
-            bigdf = pd.DataFrame(columns=['viewid','Url',dimensions,metrics])
-        else:
-            bigdf = pd.DataFrame(columns=['viewid',dimensions,metrics])
-    
 
     # Authenticate and construct service.
     service = get_service('analytics', 'v3', scope, 'client_secrets.json', thisgoogleaccount)
-
-    profiles = service.management().profiles().list(
-    accountId='~all',
-    webPropertyId='~all').execute()
+    credentials = get_credentials('analytics', scope, 'client_secrets.json', thisgoogleaccount)
+
+    # the list of views rarely changes, so it is cached on disk between runs
+    profilesCacheKey = ('analytics-profiles', thisgoogleaccount)
+    profiles = None
+    if not refresh:
+        profiles = googleAPIcache.load(profilesCacheKey, max_age=profilesCacheSeconds)
+    if profiles is None:
+        profiles = service.management().profiles().list(
+        accountId='~all',
+        webPropertyId='~all').execute(num_retries=retries)
+        googleAPIcache.save(profilesCacheKey, profiles)
     #profiles is now list    
 
     if debugvar: print("Processing: " + thisgoogleaccount)
     if debugvar: print("Total profiles: " + str(profiles['totalResults']))
 
-    bar = IncrementalBar('Processing',max=profiles['totalResults'])
+    items = profiles['items']
+    if test is not None:
+        items = items[:test]
+    # only starred views get queried
+    starredItems = [item for item in items if 'starred' in item]
 
-    itemcounter = 0
+    bar = IncrementalBar('Processing',max=len(starredItems))
 
-    for item in profiles['items']:
-        dataPresent = False
-        if test is not None and itemcounter == test:
-            break
-        bar.next()
-        if 'starred' in item:
-            smalldf = pd.DataFrame()
-            if debugvar: print(item['id'] + ',' + start_date + ',' + end_date)
-            
-            if debugvar: print("Try querying: "+ str(item['id'])+":"+  item['websiteUrl'])
-            try:
-                results = service.data().ga().get(
-                ids='ga:' + str(item['id']),
-                start_date=start_date,
-                end_date=end_date,
-                filters=filters,
-                #sort='-ga:pageviews', 
-                max_results='1000',
-                dimensions= dimensions,
-                metrics= metrics).execute()
-                if results['totalResults'] > 0:
-                    dataPresent = True
-            except HttpError as err:
-                # if err.resp.get('content-type', '').startswith('application/json'):
-                #     reason = json.loads(err.content).get('error').get('errors')[0].get('reason')
-                #     raise HttpError("HTTP data was invalid or unexpected /n Reason is:",)
-                #     print(reason)
-                # else:
-                #     raise HttpError("HTTP data was invalid or unexpected")
-                print(err.resp.status, err._get_reason())
-            except:
-                if debugvar: print("GA call failed for " + item['websiteUrl'])
-                dataPresent = False
-
-            if dataPresent:
-                if debugvar: print("returned rows: " + str(results['rows']))
-                if debugvar: print(smalldf)
-                smalldf = smalldf.append(results['rows'])
-                if debugvar: print(smalldf)
-                smalldf.columns = [dimensions] + splitMetrics
-                if debugvar: print(smalldf)
-            
-                smalldf.insert(0,'viewid',item['id'])
-                if debugvar: print(smalldf)
-
-                smalldf.insert(1,'websiteUrl',item['websiteUrl'])
-                if dimensions == "ga:pagePath":
-                    smalldf['Url'] = smalldf['websiteUrl'] + smalldf[dimensions]
-                
-                rootDomain = urlparse(item['websiteUrl']).hostname
-                if 'www.' in rootDomain:
-                    rootDomain = rootDomain.replace('www.','')
-                smalldf.insert(0,'rootDomain',rootDomain)
-
-                bigdf = pd.concat([bigdf,smalldf],sort=True)
-                if debugvar: print(bigdf)
-        itemcounter += 1
+    # map keeps the results in view order so the output is the same as a serial run
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for smalldf in executor.map(lambda item: fetchView(service, credentials, item), starredItems):
+            bar.next()
+            if smalldf is not None:
+                frames.append(smalldf)
     bar.finish()
 
-    # Got the bigdf now of all the data from this account, so add it into the combined
-    combinedDF = pd.concat([combinedDF,bigdf],sort=True)
+    if output == "csv" and frames:
+        # write this account out now so its rows don't stay in memory
+        append_csv(frames, name + '.csv', not csvStarted)
+        csvStarted = True
+        frames = []
 
     # Probably not necessary to actually delete them, but makes the code easier for me to understand
     #del smalldf
-    # del bigdf
     # del profiles
     # del service
 
 # Finished collecting everything, time to output to a file
-if googleaccountstring > "" :
-    name = googleaccountstring + "-" + name 
-
-combinedDF[splitMetrics] = combinedDF[splitMetrics].apply(pd.to_numeric)
-
-combinedDF.reset_index()
-
-with ExcelWriter(name + '.xlsx') as writer:
-  combinedDF.to_excel(writer, sheet_name='data')
-  optionsdf.to_excel(writer,sheet_name="Options")
-print("finished and outputed to excel file")
-
+if output != "csv":
+    # the empty combinedDF is left out of the concat when there is data, its object
+    # columns would turn the already numeric metrics back into objects
+    if frames:
+        combinedDF = pd.concat(frames, sort=True)
+    if debugvar: print(combinedDF)
+
+    # these repeat the same few values on every row of a view, so store them as codes
+    for column in ['viewid','websiteUrl','rootDomain']:
+        if column in combinedDF:
+            combinedDF[column] = combinedDF[column].astype('category')
+
+    combinedDF.reset_index()
+elif not csvStarted:
+    # no view returned data, csv runs still leave a file with the header a run
+    # with data would have
+    empty_csv(templateColumns, name + '.csv')
+
+write_results(combinedDF, name, output, len(combinedDF), optionsColumns, options)
@@ -1,20 +1,36 @@
 import argparse
 import datetime
-import win_unicode_console
-from apiclient.discovery import build
-import httplib2
-from oauth2client import client
-from oauth2client import file
-from oauth2client import tools
-import pandas as pd
-from pandas import ExcelWriter
-import openpyxl
-from progress.bar import IncrementalBar
-from googleAPIget_service import get_service
-from urllib.parse import urlparse
-
-win_unicode_console.enable()
-
+import json
+import os
+import random
+import re
+import time
+import googleAPIcache
+from googleAPIdomains import root_domain
+
+# only the Windows console needs fixing up for unicode output
+if os.name == 'nt':
+    import win_unicode_console
+    win_unicode_console.enable()
+
+
+daysAgoPattern = re.compile(r'^([0-9]+)daysago$', re.IGNORECASE)
+
+def gscDate(value):
+    # Search Console only accepts yyyy-mm-dd, so relative dates are worked out here
+    # once, and anything else fails now instead of on the first site
+    today = datetime.date.today()
+    if value == 'today':
+        return today.isoformat()
+    if value == 'yesterday':
+        return (today - datetime.timedelta(days=1)).isoformat()
+    daysAgo = daysAgoPattern.match(value)
+    if daysAgo:
+        return (today - datetime.timedelta(days=int(daysAgo.group(1)))).isoformat()
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%d").date().isoformat()
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid date '" + value + "', use yyyy-mm-dd, 'today', 'yesterday' or '7DaysAgo'")
 
 parser = argparse.ArgumentParser()
 
@@ -22,129 +38,309 @@ parser = argparse.ArgumentParser()
 
 
 #parser.add_argument("viewProfileID",type=int, help="GA View (profile) ID as a number") !!!already got this from loop!!!
-parser.add_argument("start_date", help="start date in format yyyy-mm-dd or 'yesterday' '7DaysAgo'")
-parser.add_argument("end_date", help="start date in format yyyy-mm-dd or 'today'")
+parser.add_argument("start_date", type=gscDate, help="start date in format yyyy-mm-dd or 'yesterday' '7DaysAgo'")
+parser.add_argument("end_date", type=gscDate, help="start date in format yyyy-mm-dd or 'today'")
 parser.add_argument("-t", "--type", default="web", choices=("image","video","web"), help="Search types for the returned data, default is web")
 #parser.add_argument("-f","--filters",default=2,type=int, help="Minimum number for metric, default is 2")
 parser.add_argument("-d","--dimensions",default="page", help="The dimensions are the left hand side of the table, default is page. Options are date, query, page, country, device.  Combine two by specifying -d page,query ")
 #parser.add_argument("-m","--metrics",default="pageviews", help="The metrics are the things on the left, default is pageviews")
 parser.add_argument("-n","--name",default='search-console-[dimensions]-[datestring]',type=str, help="File name for final output, default is search-console- + the current date. You do NOT need to add file extension")
+parser.add_argument("-o","--output",default="auto",choices=("auto","xlsx","csv"), help="Output file type, default is auto which writes xlsx unless there are more than 100000 rows, then csv. csv writes each account's rows out as soon as it is done instead of keeping everything in memory, use it for big downloads.")
 #parser.add_argument("-c", "--clean", action="count", default=0, help="clean output skips header and count and just sends csv rows")
+parser.add_argument("--domain",type=str, default="", help="Only query sites on this domain or its subdomains, e.g. example.com. Default is every site the account can see.")
+parser.add_argument("--refresh",action="store_true", help="Ignore cached data and fetch it again: the list of sites (kept for a day, refresh after adding a site to Search Console) and results of queries that ended more than three days ago.")
+parser.add_argument("--retries",default=5,type=int, help="How many times a request is retried, with an increasing random wait, when Search Console reports a rate limit or server error. Default is 5.")
+parser.add_argument("-b","--batch-size",default=10,type=int, help="How many Search Console queries are sent together in one batch request, default is 10. Every query still counts against the quota, the size is halved automatically while Search Console reports rate limits.")
 parser.add_argument("-g","--googleaccount",type=str, default="", help="Name of a google account; does not have to literally be the account name but becomes a token to access that particular set of secrets. Client secrets will have to be in this a file that is this string concatenated with client_secret.json.  OR if this is the name of a text file then every line in the text file is processed as one user and all results appended together into a file file")
 
 args = parser.parse_args()
 
+# pandas and the Google client libraries take a while to load, so they are only
+# imported once the arguments are known to be good (--help stays instant)
+import httplib2
+import numpy as np
+import pandas as pd
+from googleAPIoutput import append_csv, empty_csv, write_results
+from googleAPIget_service import get_service, get_accounts
+from progress.bar import IncrementalBar
+from googleapiclient.errors import HttpError
+
 start_date = args.start_date
 end_date = args.end_date
 
 dimensionsstring = args.dimensions
 dimensionsarray = dimensionsstring.split(",")
 multidimention = len(dimensionsarray) > 1
+# one key-n column per dimension when there are several, named like this to
+# avoid the key1 reserved word problem
+keyColumns = ['key-' + str(keyIndex + 1) for keyIndex in range(len(dimensionsarray))]
+
+# columns that repeat the same few values on every row are stored as codes, that is
+# the site columns and the dimensions with only a handful of possible values
+fewValueDimensions = ('country', 'device', 'searchAppearance')
+categoryColumns = ['siteUrl', 'rootDomain']
+if dimensionsarray[0] in fewValueDimensions:
+    categoryColumns.append('keys')
+if multidimention:
+    categoryColumns += [keyColumn for keyColumn, dimension in zip(keyColumns, dimensionsarray) if dimension in fewValueDimensions]
 
 name = args.name
 dataType = args.type
 googleaccountstring = args.googleaccount
+refresh = args.refresh
+output = args.output
+# compared against each site's root domain, so urls and www. are fine here too
+domainFilter = root_domain(args.domain.strip()) if args.domain.strip() else None
+retries = args.retries
+batchSize = max(1, args.batch_size)
 
 if name == 'search-console-[dimensions]-[datestring]':
     name = 'search-console-' + dimensionsstring + '-' + datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
 
 scope = ['https://www.googleapis.com/auth/webmasters.readonly']
 
-
-try:
-    googleaccountslist = open(googleaccountstring).read().splitlines()
-    # remove empty lines
-    googleaccountslist = [x.strip() for x in googleaccountslist if x.strip()]
-except:
-    googleaccountslist = [googleaccountstring]
+sitesCacheSeconds = 24 * 60 * 60
+
+# Query results are only cached when they can't change anymore, Search Console
+# keeps updating a day's numbers for up to three days
+lastFinalDate = (datetime.date.today() - datetime.timedelta(days=3)).isoformat()
+cacheResults = end_date < lastFinalDate
+
+# rate limits and server errors are worth retrying, anything else is a real error
+retryableStatuses = (429, 500, 502, 503, 504)
+# a 403 with one of these reasons is a rate limit rather than missing permission.
+# googleapiclient's num_retries only retries the first two, servingLimitExceeded is
+# added on purpose: it means Search Console is shedding load for a while, so the
+# query should be slowed down and retried like the others, not dropped
+rateLimitReasons = ('rateLimitExceeded', 'userRateLimitExceeded', 'servingLimitExceeded')
+
+def isRateLimited(exception):
+    if not isinstance(exception, HttpError):
+        return False
+    if exception.resp.status == 429:
+        return True
+    if exception.resp.status != 403:
+        return False
+    try:
+        error = json.loads(exception.content.decode('utf-8'))['error']
+        reasons = [detail.get('reason') for detail in error.get('errors', []) + error.get('details', [])]
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return False
+    return any(reason in rateLimitReasons for reason in reasons)
+
+def isRetryable(exception):
+    if isinstance(exception, (OSError, httplib2.HttpLib2Error)):
+        # timeouts and dropped connections on the batch request itself
+        return True
+    return isRateLimited(exception) or (isinstance(exception, HttpError) and exception.resp.status in retryableStatuses)
+
+# the most rows the API returns per query, bigger results are paged with startRow
+rowLimit = 25000
+
+# the metrics every searchanalytics row comes back with
+metricColumns = ['clicks', 'impressions', 'ctr', 'position']
+# the counts are stored as int32, or int64 when a total is too big for it, so every
+# site gets the same type. ctr and position stay float64 so excel doesn't show
+# float32 rounding noise
+countColumns = ['clicks', 'impressions']
+int32Max = np.iinfo('int32').max
+
+# the query is the same for every site
+queryBody = {
+    'startDate': start_date,
+    'endDate': end_date,
+    'dimensions': dimensionsarray,
+    'searchType': dataType,
+    'rowLimit': rowLimit
+}
+
+
+googleaccountslist = get_accounts(googleaccountstring)
 
 #print(googleaccountslist)
 
-combinedDF = pd.DataFrame()
+if googleaccountstring > "" :
+    name = googleaccountstring + "-" + name 
+
+# Every site's DataFrame is collected here and concatenated once at the end,
+# concatenating inside the loop copies everything collected so far each time
+frames = []
+csvStarted = False
+# counted as sites come in, with csv output the rows are gone from memory by the end
+rowCount = 0
 
 for thisgoogleaccount in googleaccountslist:
     print("Processing: " + thisgoogleaccount)
     # Authenticate and construct service.
     service = get_service('webmasters', 'v3', scope, 'client_secrets.json', thisgoogleaccount)
-    profiles = service.sites().list().execute()
+    # the list of sites rarely changes, so it is cached on disk between runs
+    sitesCacheKey = ('webmasters-sites', thisgoogleaccount)
+    profiles = None
+    if not refresh:
+        profiles = googleAPIcache.load(sitesCacheKey, max_age=sitesCacheSeconds)
+    if profiles is None:
+        profiles = service.sites().list().execute(num_retries=retries)
+        googleAPIcache.save(sitesCacheKey, profiles)
     #profiles is now list    
 
     #print("Len Profiles siteEntry: " + str(len(profiles['siteEntry'])))
 
-    bar = IncrementalBar('Processing',max=len(profiles['siteEntry']))
-
-
-    bigdf = pd.DataFrame()
-
-    for item in profiles['siteEntry']:
-        bar.next()
-        if item['permissionLevel'] != 'siteUnverifiedUser':
-
-            smalldf = pd.DataFrame()
-
-            #print(item['id'] + ',' + start_date + ',' + end_date)
-            results = service.searchanalytics().query(
-            siteUrl=item['siteUrl'], body={
-                'startDate': start_date,
-                'endDate': end_date,
-                'dimensions': dimensionsarray,
-                'searchType': dataType,
-                'rowLimit': 5000
-            }).execute()
-
-            if len(results) == 2:
-                #print(results['rows'])
-                #print(smalldf)
-                smalldf = smalldf.append(results['rows'])
-                #print(smalldf)
-
-                if multidimention:
-                    #solves key1 reserved word problem
-                    smalldf[['key-1','key-2']] = pd.DataFrame(smalldf['keys'].tolist(), index= smalldf.index)
-                    smalldf['keys']
-
-                rootDomain = urlparse(item['siteUrl']).hostname
-                if 'www.' in rootDomain:
-                    rootDomain = rootDomain.replace('www.','')
-
-                smalldf.insert(0,'siteUrl',item['siteUrl'])
-                smalldf.insert(0,'rootDomain',rootDomain)
-                #print(smalldf)
-                if len(bigdf.columns) == 0:
-                    bigdf = smalldf.copy()
+    # sites we aren't verified for can't be queried
+    verifiedSites = [item for item in profiles['siteEntry'] if item['permissionLevel'] != 'siteUnverifiedUser']
+    if domainFilter is not None:
+        # filtered before any query so other sites don't use up quota
+        verifiedSites = [item for item in verifiedSites
+            if root_domain(item['siteUrl']) == domainFilter or root_domain(item['siteUrl']).endswith('.' + domainFilter)]
+
+    bar = IncrementalBar('Processing',max=len(verifiedSites))
+
+    # the queries are sent in batches, one http round trip covers several sites.
+    # Each query is a (site index, startRow, attempt) page, a full page queues the next one
+    siteRows = [[] for item in verifiedSites]
+    siteErrors = {}
+    pending = []
+    for index, item in enumerate(verifiedSites):
+        cachedRows = None
+        if cacheResults and not refresh:
+            cachedRows = googleAPIcache.load(('webmasters-data', item['siteUrl'], queryBody))
+        if cachedRows is None:
+            pending.append((index, 0, 0))
+        else:
+            siteRows[index] = cachedRows
+    fetchedSites = [query[0] for query in pending]
+    bar.next(len(verifiedSites) - len(fetchedSites))
+    retryQueries = []
+    rateLimited = []
+
+    def collectResult(requestId, response, exception):
+        index, startRow, attempt = [int(part) for part in requestId.split('-')]
+        if exception is not None:
+            if isRateLimited(exception):
+                rateLimited.append(index)
+            if isRetryable(exception) and attempt < retries:
+                retryQueries.append((index, startRow, attempt + 1))
+            else:
+                siteErrors[index] = exception
+            return
+        rows = response.get('rows', [])
+        siteRows[index].extend(rows)
+        if len(rows) == rowLimit:
+            pending.append((index, startRow + rowLimit, 0))
+
+    # shrinks while the quota is being hit and grows back once batches go through
+    accountBatchSize = batchSize
+    # the last wait, each new one is random between a second and three times this
+    # (decorrelated jitter) so queries that failed together don't retry in lockstep
+    retrySleep = 1
+    # set when the next batch should wait first, so one failure round only waits once
+    waitFirst = False
+
+    while pending or retryQueries:
+        if not pending:
+            # only failed queries are left, give the API a moment before trying again
+            pending.extend(retryQueries)
+            del retryQueries[:]
+            waitFirst = True
+        if waitFirst:
+            retrySleep = min(60, random.uniform(1, retrySleep * 3))
+            time.sleep(retrySleep)
+            waitFirst = False
+        batchQueries = pending[:accountBatchSize]
+        del pending[:accountBatchSize]
+        del rateLimited[:]
+        batch = service.new_batch_http_request(callback=collectResult)
+        for index, startRow, attempt in batchQueries:
+            body = dict(queryBody, startRow=startRow)
+            batch.add(service.searchanalytics().query(siteUrl=verifiedSites[index]['siteUrl'], body=body),
+                request_id=str(index) + '-' + str(startRow) + '-' + str(attempt))
+        try:
+            batch.execute()
+        except (HttpError, OSError, httplib2.HttpLib2Error) as err:
+            # the whole batch failed before any query was answered, so every query
+            # in it gets retried like a failed sub-request, or is given up on
+            if not isRetryable(err):
+                raise
+            if isRateLimited(err):
+                rateLimited.extend(query[0] for query in batchQueries)
+            for index, startRow, attempt in batchQueries:
+                if attempt < retries:
+                    retryQueries.append((index, startRow, attempt + 1))
                 else:
-                    bigdf = pd.concat([bigdf,smalldf])
-
-                #print(bigdf)
+                    siteErrors[index] = err
+        bar.next(len([query for query in batchQueries if query[1] == 0 and query[2] == 0]))
+
+        if rateLimited:
+            # send fewer queries at a time and give the quota a moment to recover
+            accountBatchSize = max(1, accountBatchSize // 2)
+            waitFirst = True
+        else:
+            accountBatchSize = min(batchSize, accountBatchSize * 2)
+            if not retryQueries:
+                # nothing is waiting to be retried, start the waits small again
+                retrySleep = 1
+
+    if cacheResults:
+        for index in fetchedSites:
+            if index not in siteErrors:
+                googleAPIcache.save(('webmasters-data', verifiedSites[index]['siteUrl'], queryBody), siteRows[index])
+
+    for index, item in enumerate(verifiedSites):
+        if index in siteErrors:
+            print(item['siteUrl'], siteErrors[index])
+            continue
+
+        rows = siteRows[index]
+        if rows:
+            #print(rows)
+
+            # build the columns in one pass and hand them to pandas together
+            columns = {'keys': [row['keys'][0] for row in rows]}
+            for metric in metricColumns:
+                columns[metric] = [row[metric] for row in rows]
+
+            if multidimention:
+                for keyIndex, keyColumn in enumerate(keyColumns):
+                    columns[keyColumn] = [row['keys'][keyIndex] for row in rows]
+
+            smalldf = pd.DataFrame(columns)
+            for column in countColumns:
+                smalldf[column] = smalldf[column].astype('int32' if smalldf[column].max() <= int32Max else 'int64')
+
+            smalldf.insert(0,'siteUrl',item['siteUrl'])
+            smalldf.insert(0,'rootDomain',root_domain(item['siteUrl']))
+            #print(smalldf)
+            frames.append(smalldf)
+            rowCount += len(rows)
     bar.finish()
 
-    bigdf.reset_index()
-    #bigdf.to_json("output.json",orient="records")
-
-    if len(bigdf) > 0:
-        bigdf['keys'] = bigdf["keys"].str[0]
-
-        # Got the bigdf now of all the data from this account, so add it into the combined
-        combinedDF = pd.concat([combinedDF,bigdf],sort=True)
+    if output == "csv" and frames:
+        # write this account out now so its rows don't stay in memory
+        append_csv(frames, name + '.csv', not csvStarted)
+        csvStarted = True
+        frames = []
 
     # clean up objects used in this pass
-    del bigdf
     del profiles
     del service
 
 
-if len(combinedDF) > 0:
-    if googleaccountstring > "" :
-        name = googleaccountstring + "-" + name 
+combinedDF = pd.concat(frames, sort=True) if frames else pd.DataFrame()
+
+# Done after the concat, per site categories would be turned back into strings by it
+for column in categoryColumns:
+    if column in combinedDF:
+        combinedDF[column] = combinedDF[column].astype('category')
 
-    options = [[start_date,end_date,dimensionsstring,name,dataType,googleaccountstring]]
-    optionsdf = pd.DataFrame(options, columns=["start_date","end_date","dimensions","name","Data Type","Google Account"])
+if rowCount == 0:
+    print("nothing found")
+    if output == "csv":
+        # csv runs always leave a file, with the header a run with data would have
+        empty_csv(['rootDomain', 'siteUrl', 'keys'] + metricColumns + (keyColumns if multidimention else []), name + '.csv')
+
+if rowCount > 0 or output == "csv":
+    optionsColumns = ["start_date","end_date","dimensions","name","Data Type","Google Account"]
+    options = [start_date,end_date,dimensionsstring,name,dataType,googleaccountstring]
 
     combinedDF.reset_index()
 
-    with ExcelWriter(name + '.xlsx') as writer:
-        combinedDF.to_excel(writer, sheet_name='data')
-        optionsdf.to_excel(writer,sheet_name="Options")
-        print("finished and outputed to excel file")
-else:
-    print("nothing found")
+    write_results(combinedDF, name, output, rowCount, optionsColumns, options)
@@ -0,0 +1,57 @@
+import hashlib
+import json
+import os
+import time
+
+
+CACHE_DIR = '.cache'
+
+
+def cache_path(key):
+  """Get the file a cache entry is stored in.
+
+  Args:
+    key: A tuple of JSON serialisable values identifying the entry.
+
+  Returns:
+    The path of the JSON file inside CACHE_DIR for that key.
+  """
+  # only needs to tell keys apart, not resist attacks, blake2b is the fastest stdlib hash
+  digest = hashlib.blake2b(json.dumps(key, sort_keys=True).encode('utf-8'), digest_size=16).hexdigest()
+  return os.path.join(CACHE_DIR, digest + '.json')
+
+
+def load(key, max_age=None):
+  """Load a cached API response.
+
+  Args:
+    key: A tuple of JSON serialisable values identifying the entry.
+    max_age: Optional age in seconds after which the entry counts as stale.
+
+  Returns:
+    The cached data, or None if there is no usable entry.
+  """
+  path = cache_path(key)
+  try:
+    if max_age is not None and time.time() - os.path.getmtime(path) > max_age:
+      return None
+    with open(path) as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return None
+
+
+def save(key, data):
+  """Store an API response so later runs can skip the request.
+
+  Args:
+    key: A tuple of JSON serialisable values identifying the entry.
+    data: The JSON serialisable response to store.
+  """
+  os.makedirs(CACHE_DIR, exist_ok=True)
+  path = cache_path(key)
+  # write to a temporary file first so an interrupted run never leaves half an entry
+  temp_path = path + '.' + str(os.getpid()) + '.tmp'
+  with open(temp_path, 'w') as f:
+    json.dump(data, f)
+  os.replace(temp_path, path)
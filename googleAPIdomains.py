@@ -0,0 +1,23 @@
+import functools
+from urllib.parse import urlparse
+
+
+@functools.lru_cache(maxsize=None)
+def root_domain(url):
+  """Get the domain of a GA website url or Search Console property.
+
+  Args:
+    url: A url such as https://www.example.com/, a bare host, or an
+      sc-domain:example.com domain property.
+
+  Returns:
+    The lower case host name without a leading www., or '' if there is none.
+  """
+  if url.startswith('sc-domain:'):
+    host = url[len('sc-domain:'):].lower()
+  else:
+    # without a scheme urlparse sees the host as a path
+    host = urlparse(url if '//' in url else '//' + url).hostname or ''
+  if host.startswith('www.'):
+    host = host[len('www.'):]
+  return host
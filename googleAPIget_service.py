@@ -1,4 +1,5 @@
 import argparse
+import os
 import httplib2
 
 from apiclient.discovery import build
@@ -7,52 +8,98 @@ from oauth2client import tools
 from oauth2client import client
 
 
-def get_service(api_name, api_version, scope, client_secrets_path, usernameToken = ""):
-  """Get a service that communicates to a Google API.
+# Credentials and service objects are cached per process, keyed by the token
+# file / api, so scripts looping over accounts or calling get_service
+# repeatedly don't re-read tokens, re-run the flow or rebuild the service.
+_credentials_cache = {}
+_service_cache = {}
+
+
+def get_credentials(api_name, scope, client_secrets_path, usernameToken = ""):
+  """Get OAuth2 credentials for a Google API, running the auth flow if needed.
 
   Args:
-    api_name: string The name of the api to connect to.
-    api_version: string The api version to connect to.
+    api_name: string The name of the api the credentials are for.
     scope: A list of strings representing the auth scopes to authorize for the
       connection.
     client_secrets_path: string A path to a valid client secrets file.
 
   Returns:
-    A service that is connected to the specified API.
+    Valid oauth2client credentials, cached for the life of the process.
   """
-  # Parse command-line arguments.
-  parser = argparse.ArgumentParser(
-      formatter_class=argparse.RawDescriptionHelpFormatter,
-      parents=[tools.argparser])
-  flags = parser.parse_args([])
-
   if usernameToken == "":
     combined_client_secrets_path = client_secrets_path
+    combined_data_file_name = api_name + '.dat'
   else:
     combined_client_secrets_path = usernameToken+"-"+client_secrets_path
+    combined_data_file_name = usernameToken+"-"+api_name + '.dat'
 
-  # Set up a Flow object to be used if we need to authenticate.
-  flow = client.flow_from_clientsecrets(
-      combined_client_secrets_path, scope=scope,
-      message=tools.message_if_missing(combined_client_secrets_path))
+  credentials = _credentials_cache.get(combined_data_file_name)
+  if credentials is not None and not credentials.invalid:
+    return credentials
 
   # Prepare credentials, and authorize HTTP object with them.
   # If the credentials don't exist or are invalid run through the native client
   # flow. The Storage object will ensure that if successful the good
   # credentials will get written back to a file.
-
-  if usernameToken == "":
-    combined_data_file_name = api_name + '.dat'
-  else:
-    combined_data_file_name = usernameToken+"-"+api_name + '.dat'
-
   storage = file.Storage(combined_data_file_name)
   credentials = storage.get()
   if credentials is None or credentials.invalid:
+    # Only needed when we have to authenticate, so not built for stored tokens.
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        parents=[tools.argparser])
+    flags = parser.parse_args([])
+
+    flow = client.flow_from_clientsecrets(
+        combined_client_secrets_path, scope=scope,
+        message=tools.message_if_missing(combined_client_secrets_path))
+
     credentials = tools.run_flow(flow, storage, flags)
+
+  _credentials_cache[combined_data_file_name] = credentials
+  return credentials
+
+
+def get_service(api_name, api_version, scope, client_secrets_path, usernameToken = ""):
+  """Get a service that communicates to a Google API.
+
+  Args:
+    api_name: string The name of the api to connect to.
+    api_version: string The api version to connect to.
+    scope: A list of strings representing the auth scopes to authorize for the
+      connection.
+    client_secrets_path: string A path to a valid client secrets file.
+
+  Returns:
+    A service that is connected to the specified API.
+  """
+  cache_key = (api_name, api_version, usernameToken)
+  service = _service_cache.get(cache_key)
+  if service is not None:
+    return service
+
+  credentials = get_credentials(api_name, scope, client_secrets_path, usernameToken)
   http = credentials.authorize(http=httplib2.Http())
 
   # Build the service object.
   service = build(api_name, api_version, http=http)
 
-  return service
\ No newline at end of file
+  _service_cache[cache_key] = service
+  return service
+
+
+def get_accounts(googleaccount):
+  """Get the google accounts a script should process.
+
+  Args:
+    googleaccount: string Either one account token, or the name of a text file
+      with one account token per line.
+
+  Returns:
+    A list of account tokens, without blank lines.
+  """
+  if not os.path.isfile(googleaccount):
+    return [googleaccount]
+  with open(googleaccount) as accountsfile:
+    return [line.strip() for line in accountsfile if line.strip()]
@@ -0,0 +1,63 @@
+import pandas as pd
+from pandas import ExcelWriter
+
+
+# with --output auto bigger results are written as csv instead of xlsx, workbooks
+# this big take a lot of memory to write and are no use in Excel anyway
+EXCEL_MAX_ROWS = 100000
+
+
+def append_csv(frames, path, header):
+  """Append one account's rows to a csv file so they don't stay in memory.
+
+  Args:
+    frames: A list of DataFrames with the same columns.
+    path: string The csv file to write to.
+    header: bool True for the first account, which starts a new file with a
+      header row.
+  """
+  # sort=True puts the columns in the same order for every account
+  pd.concat(frames, sort=True).to_csv(path, mode='w' if header else 'a', header=header, index=False)
+
+
+def empty_csv(columns, path):
+  """Write a csv with only the header row, for a run where nothing came back.
+
+  Args:
+    columns: A list of the columns a run with data would have.
+    path: string The csv file to write.
+  """
+  # sorted the same way as append_csv's concat, so the header matches a run with data
+  pd.DataFrame(columns=sorted(columns)).to_csv(path, index=False)
+
+
+def write_results(df, name, output, row_count, options_columns, options):
+  """Write the results and the options they were fetched with.
+
+  Args:
+    df: The combined DataFrame, empty if the rows were already written with
+      append_csv.
+    name: string The file name without extension.
+    output: string The --output choice, 'auto', 'xlsx' or 'csv'.
+    row_count: int How many rows were fetched in total.
+    options_columns: A list of the option names.
+    options: A list of the option values, in the same order.
+  """
+  if output == 'auto' and row_count > EXCEL_MAX_ROWS:
+    print(str(row_count) + " rows is too many for a useful excel file, writing csv instead")
+    df.to_csv(name + '.csv', index=False)
+    output = 'csv'
+
+  if output == 'csv':
+    pd.DataFrame([options], columns=options_columns).to_csv(name + '-options.csv', index=False)
+    print("finished and outputed to csv file")
+  else:
+    # xlsxwriter writes much faster than openpyxl and keeps less in memory. Urls stay
+    # plain strings, Excel only allows 65530 hyperlinks per sheet
+    with ExcelWriter(name + '.xlsx', engine='xlsxwriter', engine_kwargs={'options': {'strings_to_urls': False}}) as writer:
+      df.to_excel(writer, sheet_name='data')
+      # the options are a single row, written straight to the sheet
+      options_sheet = writer.book.add_worksheet('Options')
+      options_sheet.write_row(0, 0, options_columns)
+      options_sheet.write_row(1, 0, options)
+    print("finished and outputed to excel file")